@@ -75,7 +75,7 @@ def transfer_to_postgres(redis_manager, postgres_manager):
 
 def verify_postgres_data(postgres_manager):
     logger.info("Verifying data in PostgreSQL...")
-    with postgres_manager.get_cursor(commit=False) as cursor:
+    with postgres_manager.get_read_cursor() as cursor:
         cursor.execute("SELECT COUNT(*) FROM stock_prices")
         count = cursor.fetchone()[0]
         logger.info(f"Total records in stock_prices table: {count}")
@@ -1,5 +1,9 @@
+import asyncio
+import aiohttp
 import yfinance as yf
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 
 # API keys for Alpha Vantage and Finnhub
@@ -9,6 +13,12 @@ FINNHUB_API_KEY = os.getenv('FINNHUB_API_KEY', 'your_finnhub_api_key')
 # List of symbols (stocks and index funds)
 SYMBOLS = ['AAPL', 'MSFT', 'GOOG', 'AMZN', 'SPY', 'VIX']
 
+REQUEST_TIMEOUT = 10
+
+# Shared session so repeated API calls reuse kept-alive TCP/TLS connections
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.3)))
+
 # Fetch current price and historical data using yfinance for multiple symbols
 # Fetch current price and historical data using yfinance for multiple symbols
 def fetch_yahoo_finance_data(symbols):
@@ -35,7 +45,7 @@ def fetch_yahoo_finance_data(symbols):
 # Fetch VIX (Volatility Index) using Finnhub API
 def fetch_volatility_index():
     url = f'https://finnhub.io/api/v1/quote?symbol=VIX&token={FINNHUB_API_KEY}'
-    response = requests.get(url)
+    response = _session.get(url, timeout=REQUEST_TIMEOUT)
     data = response.json()
 
     if 'c' in data:  # 'c' stands for current price
@@ -46,22 +56,33 @@ def fetch_volatility_index():
     return {'error': 'Failed to fetch VIX data'}
 
 
-# Fetch current prices using Alpha Vantage for multiple symbols
-def fetch_alpha_vantage_prices(symbols):
-    results = []
-    for symbol in symbols:
-        url = f'https://www.alphavantage.co/query?function=TIME_SERIES_INTRADAY&symbol={symbol}&interval=5min&apikey={ALPHA_VANTAGE_API_KEY}'
-        response = requests.get(url)
-        data = response.json()
+# Fetch the latest intraday close for one symbol from Alpha Vantage
+async def fetch_alpha_vantage_price_async(session, symbol):
+    url = f'https://www.alphavantage.co/query?function=TIME_SERIES_INTRADAY&symbol={symbol}&interval=5min&apikey={ALPHA_VANTAGE_API_KEY}'
+    try:
+        async with session.get(url) as response:
+            data = await response.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        # ValueError: a non-JSON body, e.g. an HTML error page
+        return {'symbol': symbol, 'error': f"Failed to fetch data for {symbol}"}
 
-        if 'Time Series (5min)' in data:
-            latest_time = list(data['Time Series (5min)'].keys())[0]
-            latest_price = data['Time Series (5min)'][latest_time]['4. close']
-            results.append({'symbol': symbol, 'current_price': latest_price})
-        else:
-            results.append({'symbol': symbol, 'error': f"Failed to fetch data for {symbol}"})
+    time_series = data.get('Time Series (5min)')
+    if time_series:
+        latest_price = time_series[next(iter(time_series))]['4. close']
+        return {'symbol': symbol, 'current_price': latest_price}
+    return {'symbol': symbol, 'error': f"Failed to fetch data for {symbol}"}
 
-    return results
+
+# Fetch current prices using Alpha Vantage for multiple symbols, with all requests in flight at once
+async def fetch_alpha_vantage_prices_async(symbols):
+    connector = aiohttp.TCPConnector(limit=32)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        return await asyncio.gather(*[fetch_alpha_vantage_price_async(session, symbol) for symbol in symbols])
+
+
+def fetch_alpha_vantage_prices(symbols):
+    return asyncio.run(fetch_alpha_vantage_prices_async(symbols))
 
 
 # Fetch data for a variety of stocks and index funds
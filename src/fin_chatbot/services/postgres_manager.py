@@ -1,11 +1,15 @@
 import os
+import io
+import re
+import math
 import psycopg2
 from psycopg2 import pool, sql
-from psycopg2.extras import execute_batch
+from psycopg2.extras import execute_values
 from contextlib import contextmanager
 import logging
 from datetime import date, timedelta
 import numpy as np
+from numba import njit
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,9 +17,147 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+MARKET_SYMBOL = os.getenv('MARKET_SYMBOL', 'SPY')
+# Batches at least this large are upserted through COPY + one merge instead of multi-row INSERTs
+COPY_THRESHOLD = int(os.getenv('COPY_THRESHOLD', 10000))
+
+# Return NUMERIC columns as floats so price rows convert straight into NumPy arrays
+DEC2FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values,
+    'DEC2FLOAT',
+    lambda value, cursor: float(value) if value is not None else None
+)
+psycopg2.extensions.register_type(DEC2FLOAT)
+
+# Fixed-width tuple layout of COPY ... (FORMAT binary) for (date, float8) rows
+PGCOPY_HEADER_SIZE = 19
+PGCOPY_PRICE_ROW = np.dtype([
+    ('field_count', '>i2'),
+    ('date_size', '>i4'),
+    ('date', '>i4'),
+    ('price_size', '>i4'),
+    ('price', '>f8')
+])
+PG_EPOCH = np.datetime64('2000-01-01', 'D')
+
+METRIC_COLUMNS = (
+    'cagr_1y', 'cagr_3y', 'cagr_5y', 'volatility_1y', 'ma_50', 'ma_200',
+    'rsi_14', 'beta_1y', 'sharpe_ratio_1y', 'max_drawdown_1y'
+)
+# Decimal places of each stock_metrics column; all are DECIMAL(10, scale)
+METRIC_SCALES = {column: 2 if column in ('ma_50', 'ma_200', 'rsi_14') else 4 for column in METRIC_COLUMNS}
+
+UPSERT_METRICS_SQL = '''
+    INSERT INTO stock_metrics 
+    (symbol, date, cagr_1y, cagr_3y, cagr_5y, volatility_1y, ma_50, ma_200, rsi_14, beta_1y, sharpe_ratio_1y, max_drawdown_1y)
+    VALUES %s
+    ON CONFLICT (symbol, date) DO UPDATE
+    SET 
+        cagr_1y = EXCLUDED.cagr_1y,
+        cagr_3y = EXCLUDED.cagr_3y,
+        cagr_5y = EXCLUDED.cagr_5y,
+        volatility_1y = EXCLUDED.volatility_1y,
+        ma_50 = EXCLUDED.ma_50,
+        ma_200 = EXCLUDED.ma_200,
+        rsi_14 = EXCLUDED.rsi_14,
+        beta_1y = EXCLUDED.beta_1y,
+        sharpe_ratio_1y = EXCLUDED.sharpe_ratio_1y,
+        max_drawdown_1y = EXCLUDED.max_drawdown_1y
+'''
+
+TRADING_DAYS = 252
+RISK_FREE_RATE = 0.02
+# Annualising fewer prices than this turns short-term moves into meaningless (and overflowing) CAGRs
+MIN_CAGR_PRICES = TRADING_DAYS // 4
+
+# NaN marks undefined metrics, so keep fastmath from assuming finite values
+@njit(cache=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, nogil=True)
+def _metrics_kernel(prices, rsi_window, risk_free_rate, rsi_start, rsi_up, rsi_down):
+    # One pass over the price series; every window-based metric is accumulated as
+    # its window is entered, so no slices or separate reductions are needed.
+    # With rsi_start >= 0 the RSI recurrence resumes from saved (rsi_up, rsi_down)
+    # state at that index instead of being seeded from the first delta.
+    # The state handed back is as of the second-to-last price (NaN if RSI is not
+    # defined there), so a later revision of the last price is still picked up
+    n = prices.shape[0]
+    start_1y = max(0, n - TRADING_DAYS)
+    start_50 = max(0, n - 50)
+    start_200 = max(0, n - 200)
+    alpha = 1.0 / rsi_window
+
+    sum_50 = 0.0
+    sum_200 = 0.0
+    # Welford running mean / sum of squared deviations; stable where sumsq - mean^2 cancels
+    returns_count = 0
+    log_mean = 0.0
+    log_m2 = 0.0
+    ret_mean = 0.0
+    ret_m2 = 0.0
+    up = rsi_up
+    down = rsi_down
+    state_up = np.nan
+    state_down = np.nan
+    peak = prices[start_1y]
+    max_drawdown = 0.0
+
+    for i in range(n):
+        price = prices[i]
+        if i >= start_50:
+            sum_50 += price
+        if i >= start_200:
+            sum_200 += price
+        if i > 0:
+            prev = prices[i - 1]
+            delta = price - prev
+            # Wilder's RMA (EWMA with alpha=1/window)
+            if rsi_start < 0 and i == 1:
+                up = max(delta, 0.0)
+                down = max(-delta, 0.0)
+            elif i > rsi_start:
+                up += alpha * (max(delta, 0.0) - up)
+                down += alpha * (max(-delta, 0.0) - down)
+            if i > start_1y:
+                # Log and simple returns share one division
+                ratio = price / prev
+                log_ret = np.log(ratio)
+                ret = ratio - 1.0
+                returns_count += 1
+                log_dev = log_ret - log_mean
+                log_mean += log_dev / returns_count
+                log_m2 += log_dev * (log_ret - log_mean)
+                ret_dev = ret - ret_mean
+                ret_mean += ret_dev / returns_count
+                ret_m2 += ret_dev * (ret - ret_mean)
+        if i == n - 2 and (i >= rsi_start if rsi_start >= 0 else i >= rsi_window):
+            state_up = up
+            state_down = down
+        if i >= start_1y:
+            peak = max(peak, price)
+            max_drawdown = max(max_drawdown, (peak - price) / peak)
+
+    # The 1y log returns telescope to log(last / prices[start_1y])
+    cagr_1y = np.expm1(log_mean * returns_count * TRADING_DAYS / (n - start_1y))
+
+    volatility = np.sqrt(log_m2 / returns_count * TRADING_DAYS)
+
+    ret_std = np.sqrt(ret_m2 / returns_count)
+    sharpe = np.nan
+    if ret_std > 0.0:
+        sharpe = np.sqrt(TRADING_DAYS) * (ret_mean - risk_free_rate / TRADING_DAYS) / ret_std
+
+    rsi = np.nan
+    if rsi_start >= 0 or n > rsi_window:
+        rsi = 100.0 if down == 0.0 else 100.0 - 100.0 / (1.0 + up / down)
+
+    return (
+        cagr_1y, volatility, sum_50 / (n - start_50), sum_200 / (n - start_200),
+        rsi, sharpe, max_drawdown, state_up, state_down
+    )
+
 class PostgresManager:
     def __init__(self):
         self.pool = None
+        self._partition_years = set()
         self.db_params = {
             'dbname': os.getenv('POSTGRES_DB'),
             'user': os.getenv('POSTGRES_USER'),
@@ -59,7 +201,7 @@ class PostgresManager:
 
     def create_pool(self, minconn=1, maxconn=10):
         try:
-            self.pool = pool.SimpleConnectionPool(minconn, maxconn, **self.db_params)
+            self.pool = pool.ThreadedConnectionPool(minconn, maxconn, **self.db_params)
             logger.info("Connection pool created successfully")
         except (Exception, psycopg2.Error) as error:
             logger.error(f"Error creating connection pool: {error}", exc_info=True)
@@ -74,7 +216,7 @@ class PostgresManager:
             self.pool.putconn(conn)
 
     @contextmanager
-    def get_cursor(self, commit=True):
+    def get_cursor(self, commit=False):
         with self.get_connection() as conn:
             cursor = conn.cursor()
             try:
@@ -87,20 +229,48 @@ class PostgresManager:
             finally:
                 cursor.close()
 
+    @contextmanager
+    def get_read_cursor(self):
+        # psycopg2 opens the implicit transaction as BEGIN READ ONLY; it is rolled back, never committed
+        with self.get_connection() as conn:
+            conn.readonly = True
+            cursor = conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+                conn.rollback()
+                conn.readonly = None
+
     def close_pool(self):
         if self.pool:
             self.pool.closeall()
             logger.info("All database connections closed")
 
     def create_tables(self):
-        with self.get_cursor() as cursor:
+        with self.get_cursor(commit=True) as cursor:
+            cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('stock_prices')")
+            row = cursor.fetchone()
+            if row is None:
+                self._create_partitioned_prices_table(cursor, 'stock_prices')
+            elif row[0] == 'r':
+                self._migrate_stock_prices_to_partitioned(cursor)
+            today = date.today()
+            self._create_partitions(cursor, 'stock_prices', range(today.year - 5, today.year + 2))
+            # Unlogged staging area for COPY-based upserts; skips WAL for rows that are merged right away
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS stock_prices (
-                    id SERIAL PRIMARY KEY,
+                CREATE UNLOGGED TABLE IF NOT EXISTS stock_prices_staging (
                     symbol VARCHAR(10) NOT NULL,
                     date DATE NOT NULL,
-                    closing_price DECIMAL(10, 2) NOT NULL,
-                    UNIQUE (symbol, date)
+                    closing_price DECIMAL(10, 2) NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS stock_metric_state (
+                    symbol VARCHAR(10) PRIMARY KEY,
+                    date DATE NOT NULL,
+                    rsi_up DOUBLE PRECISION NOT NULL,
+                    rsi_down DOUBLE PRECISION NOT NULL
                 )
             ''')
             cursor.execute('''
@@ -123,27 +293,186 @@ class PostgresManager:
             ''')
         logger.info("Tables created successfully")
 
+    def _create_partitioned_prices_table(self, cursor, table_name):
+        # Yearly range partitions: cleanup drops whole years and range scans prune to the years they touch.
+        # The unique index carries closing_price so (symbol, date) range reads are index-only scans
+        cursor.execute(sql.SQL('''
+            CREATE TABLE {} (
+                id SERIAL,
+                symbol VARCHAR(10) NOT NULL,
+                date DATE NOT NULL,
+                closing_price DECIMAL(10, 2) NOT NULL,
+                PRIMARY KEY (id, date),
+                UNIQUE (symbol, date) INCLUDE (closing_price)
+            ) PARTITION BY RANGE (date)
+        ''').format(sql.Identifier(table_name)))
+        # Catches rows for years without a partition yet, so inserts never fail on a stale partition cache
+        cursor.execute(sql.SQL("CREATE TABLE stock_prices_default PARTITION OF {} DEFAULT").format(sql.Identifier(table_name)))
+
+    def _create_partitions(self, cursor, parent, years):
+        for year in years:
+            partition = f'stock_prices_{year}'
+            cursor.execute("SELECT to_regclass(%s)", (partition,))
+            if cursor.fetchone()[0] is not None:
+                continue
+            bounds = (f'{year}-01-01', f'{year + 1}-01-01')
+            cursor.execute(sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)").format(sql.Identifier(partition), sql.Identifier(parent)))
+            # Rows of this year already in the default partition must move first, or ATTACH rejects the range
+            cursor.execute(sql.SQL('''
+                WITH moved AS (
+                    DELETE FROM stock_prices_default
+                    WHERE date >= %s AND date < %s
+                    RETURNING id, symbol, date, closing_price
+                )
+                INSERT INTO {} (id, symbol, date, closing_price)
+                SELECT id, symbol, date, closing_price FROM moved
+            ''').format(sql.Identifier(partition)), bounds)
+            cursor.execute(sql.SQL(
+                "ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)"
+            ).format(sql.Identifier(parent), sql.Identifier(partition)), bounds)
+
+    def _migrate_stock_prices_to_partitioned(self, cursor):
+        logger.info("Migrating stock_prices to a partitioned table")
+        cursor.execute("SELECT DISTINCT EXTRACT(YEAR FROM date)::int FROM stock_prices")
+        years = [row[0] for row in cursor.fetchall()]
+        self._create_partitioned_prices_table(cursor, 'stock_prices_partitioned')
+        self._create_partitions(cursor, 'stock_prices_partitioned', years)
+        cursor.execute('''
+            INSERT INTO stock_prices_partitioned (id, symbol, date, closing_price)
+            SELECT id, symbol, date, closing_price FROM stock_prices
+        ''')
+        cursor.execute('''
+            SELECT setval(pg_get_serial_sequence('stock_prices_partitioned', 'id'), COALESCE(MAX(id), 0) + 1, false)
+            FROM stock_prices_partitioned
+        ''')
+        cursor.execute("DROP TABLE stock_prices")
+        cursor.execute("ALTER TABLE stock_prices_partitioned RENAME TO stock_prices")
+        # Dropping the old table freed the usual names, so the sequence and constraints can take them over
+        cursor.execute("ALTER SEQUENCE stock_prices_partitioned_id_seq RENAME TO stock_prices_id_seq")
+        cursor.execute("ALTER TABLE stock_prices RENAME CONSTRAINT stock_prices_partitioned_pkey TO stock_prices_pkey")
+        cursor.execute("ALTER TABLE stock_prices RENAME CONSTRAINT stock_prices_partitioned_symbol_date_key TO stock_prices_symbol_date_key")
+
+    def ensure_price_partitions(self, years):
+        missing_years = set(years) - self._partition_years
+        if not missing_years:
+            return
+        with self.get_cursor(commit=True) as cursor:
+            self._create_partitions(cursor, 'stock_prices', sorted(missing_years))
+        self._partition_years.update(missing_years)
+
+    def _price_partitions(self, cursor):
+        # reltuples is the planner's row estimate (-1 if never analyzed), good enough for logging
+        cursor.execute('''
+            SELECT c.relname, GREATEST(c.reltuples, 0)::bigint
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'stock_prices'::regclass
+        ''')
+        partitions = []
+        for relname, estimated_rows in cursor.fetchall():
+            match = re.fullmatch(r'stock_prices_(\d{4})', relname)
+            if match:
+                partitions.append((int(match.group(1)), relname, estimated_rows))
+        return partitions
+
     def create_indexes(self):
-        with self.get_cursor() as cursor:
+        with self.get_cursor(commit=True) as cursor:
             cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_stock_prices_symbol_date ON stock_prices (symbol, date);
+                DROP INDEX IF EXISTS idx_stock_prices_symbol_date;
                 CREATE INDEX IF NOT EXISTS idx_stock_prices_date ON stock_prices (date);
                 CREATE INDEX IF NOT EXISTS idx_stock_metrics_symbol_date ON stock_metrics (symbol, date);
             ''')
         logger.info("Indexes created successfully")
 
-    def batch_insert_stock_prices(self, data):
-        with self.get_cursor() as cursor:
-            execute_batch(cursor, '''
+    def batch_insert_stock_prices(self, data, page_size=1000):
+        self.ensure_price_partitions({price_date.year for _, price_date, _ in data})
+        if len(data) >= COPY_THRESHOLD:
+            return self.copy_stock_prices(data)
+        data = self._dedupe_prices(data)
+        with self.get_cursor(commit=True) as cursor:
+            execute_values(cursor, '''
                 INSERT INTO stock_prices (symbol, date, closing_price)
-                VALUES (%s, %s, %s)
+                VALUES %s
                 ON CONFLICT (symbol, date) 
                 DO UPDATE SET closing_price = EXCLUDED.closing_price
-            ''', data)
+            ''', data, template='(%s, %s, %s)', page_size=page_size)
+            # Saved RSI state no longer matches a series revised or backfilled on or before its date, and
+            # metrics from the written date on are stale; deleting them lets the next run pick those symbols up
+            execute_values(cursor, '''
+                WITH written (symbol, date) AS (VALUES %s),
+                stale_state AS (
+                    DELETE FROM stock_metric_state s
+                    USING written
+                    WHERE s.symbol = written.symbol AND written.date <= s.date
+                )
+                DELETE FROM stock_metrics m
+                USING written
+                WHERE m.symbol = written.symbol AND m.date >= written.date
+            ''', [(symbol, price_date) for symbol, price_date, _ in data], page_size=page_size)
         logger.info(f"Batch inserted/updated {len(data)} stock prices")
 
+    def _dedupe_prices(self, data):
+        # A multi-row upsert rejects repeated keys, so keep the last row per (symbol, date);
+        # both the INSERT and the COPY path resolve duplicates this way
+        return list({(symbol, price_date): (symbol, price_date, closing_price) for symbol, price_date, closing_price in data}.values())
+
+    def copy_stock_prices(self, data):
+        if not data:
+            return
+        self.ensure_price_partitions({price_date.year for _, price_date, _ in data})
+        # COPY into a staging table and merge once; much faster than INSERTs for backfills
+        data = self._dedupe_prices(data)
+        buf = io.StringIO()
+        for symbol, price_date, closing_price in data:
+            buf.write(f"{symbol}\t{price_date}\t{closing_price}\n")
+        buf.seek(0)
+        with self.get_cursor(commit=True) as cursor:
+            # TRUNCATE takes an exclusive lock until commit, so concurrent loads cannot mix rows
+            cursor.execute("TRUNCATE stock_prices_staging")
+            cursor.copy_expert("COPY stock_prices_staging (symbol, date, closing_price) FROM STDIN WITH (FORMAT text)", buf)
+            cursor.execute('''
+                INSERT INTO stock_prices (symbol, date, closing_price)
+                SELECT symbol, date, closing_price
+                FROM stock_prices_staging
+                ORDER BY symbol, date
+                ON CONFLICT (symbol, date)
+                DO UPDATE SET closing_price = EXCLUDED.closing_price
+            ''')
+            # Same invalidation of RSI state and metrics as batch_insert_stock_prices
+            cursor.execute('''
+                WITH stale_state AS (
+                    DELETE FROM stock_metric_state s
+                    USING stock_prices_staging st
+                    WHERE s.symbol = st.symbol AND st.date <= s.date
+                )
+                DELETE FROM stock_metrics m
+                USING stock_prices_staging st
+                WHERE m.symbol = st.symbol AND m.date >= st.date
+            ''')
+            cursor.execute("TRUNCATE stock_prices_staging")
+        logger.info(f"Copied/merged {len(data)} stock prices")
+        self.vacuum_stock_prices({price_date.year for _, price_date, _ in data})
+
+    def vacuum_stock_prices(self, years=None):
+        # Refresh the visibility map after backfills so range reads stay index-only scans;
+        # with years given only those partitions are vacuumed
+        if years is None:
+            tables = [sql.Identifier('stock_prices')]
+        else:
+            tables = [sql.Identifier(f'stock_prices_{year}') for year in sorted(years)]
+        if not tables:
+            return
+        with self.get_connection() as conn:
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(sql.SQL("VACUUM (ANALYZE) {}").format(sql.SQL(', ').join(tables)))
+            finally:
+                conn.autocommit = False
+        logger.info("Vacuumed stock_prices")
+
     def get_stock_prices(self, symbol, start_date, end_date):
-        with self.get_cursor(commit=False) as cursor:
+        with self.get_read_cursor() as cursor:
             cursor.execute('''
                 SELECT date, closing_price
                 FROM stock_prices
@@ -153,7 +482,7 @@ class PostgresManager:
             return cursor.fetchall()
 
     def get_latest_stock_price(self, symbol):
-        with self.get_cursor(commit=False) as cursor:
+        with self.get_read_cursor() as cursor:
             cursor.execute('''
                 SELECT date, closing_price
                 FROM stock_prices
@@ -165,172 +494,244 @@ class PostgresManager:
             return result if result else (None, None)
 
     def get_inserted_count(self, date):
-        with self.get_cursor(commit=False) as cursor:
+        with self.get_read_cursor() as cursor:
             cursor.execute("SELECT COUNT(*) FROM stock_prices WHERE date = %s", (date,))
             return cursor.fetchone()[0]
 
     def get_total_records(self):
-        with self.get_cursor(commit=False) as cursor:
+        with self.get_read_cursor() as cursor:
             cursor.execute("SELECT COUNT(*) FROM stock_prices")
             return cursor.fetchone()[0]
 
     def cleanup_old_data(self, days=5*365):
         cutoff_date = date.today() - timedelta(days=days)
-        with self.get_cursor() as cursor:
+        deleted_count = 0
+        dropped_years = []
+        with self.get_cursor(commit=True) as cursor:
+            # Years entirely before the cutoff are dropped as partitions instead of deleted row by row;
+            # their rows are counted from statistics rather than a COUNT(*) scan, so the total is approximate
+            for year, partition, estimated_rows in self._price_partitions(cursor):
+                if date(year + 1, 1, 1) <= cutoff_date:
+                    deleted_count += estimated_rows
+                    cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(partition)))
+                    dropped_years.append(year)
+            # Only the partition straddling the cutoff (and any old rows in the default partition) is left to DELETE from
             cursor.execute("DELETE FROM stock_prices WHERE date < %s", (cutoff_date,))
-            deleted_count = cursor.rowcount
-        logger.info(f"Deleted {deleted_count} records older than {days} days")
+            deleted_count += cursor.rowcount
+        self._partition_years.difference_update(dropped_years)
+        logger.info(f"Deleted about {deleted_count} records older than {days} days")
         return deleted_count
 
-    def _calculate_volatility(self, prices):
-        if len(prices) < 2:
-            return None
-        returns = np.diff(np.log(np.where(prices > 0, prices, np.nan)))
-        return np.nanstd(returns) * np.sqrt(252)
-
-    def _calculate_rsi(self, prices, window):
-        if len(prices) < window + 1:
-            return None
-        deltas = np.diff(prices)
-        seed = deltas[:window+1]
-        up = seed[seed >= 0].sum()/window
-        down = -seed[seed < 0].sum()/window
-        rs = up/down if down != 0 else 0
-        rsi = np.zeros_like(prices)
-        rsi[:window] = 100. - 100./(1. + rs)
-
-        for i in range(window, len(prices)):
-            delta = deltas[i - 1]
-            if delta > 0:
-                upval = delta
-                downval = 0.
-            else:
-                upval = 0.
-                downval = -delta
-
-            up = (up*(window - 1) + upval)/window
-            down = (down*(window - 1) + downval)/window
-            rs = up/down if down != 0 else 0
-            rsi[i] = 100. - 100./(1. + rs)
-
-        return rsi[-1]
-
-    def _calculate_sharpe_ratio(self, prices, risk_free_rate=0.02):
-        if len(prices) < 2:
-            return None
-        returns = np.diff(prices) / prices[:-1]
-        excess_returns = returns - risk_free_rate/252
-        if np.isnan(excess_returns).all() or len(excess_returns) == 0:
-            return None
-        return np.sqrt(252) * np.nanmean(excess_returns) / np.nanstd(excess_returns)
-
-    def calculate_metrics(self, symbol, end_date):
+    def calculate_metrics(self, symbol, end_date, prices=None, market_prices=None):
         try:
             five_years_ago = end_date - timedelta(days=5*365)
-            prices = self.get_stock_prices(symbol, five_years_ago, end_date)
+            if prices is None:
+                prices = self.get_stock_prices(symbol, five_years_ago, end_date)
             if not prices or len(prices) < 2:
                 logger.warning(f"Insufficient price data available for {symbol}")
                 return None
+            if market_prices is None:
+                market_prices = self._get_market_prices(five_years_ago, end_date)
 
-            dates, close_prices = zip(*prices)
-            close_prices = np.array([float(price) for price in close_prices if price is not None and price > 0])
+            dates, close_prices = self._to_arrays(prices)
+            return self._metrics_from_arrays(symbol, end_date, dates, close_prices, market_prices)
+        except Exception as e:
+            logger.error(f"Error calculating metrics for {symbol}: {e}")
+            return None
 
+    def _metrics_from_arrays(self, symbol, end_date, dates, close_prices, market_prices, anchors=None, rsi_state=None):
+        # anchors is (price count, first 3y price, first 5y price) when close_prices only holds the recent tail;
+        # rsi_state is the saved (date, up, down) RSI recurrence from the previous run, taken one price before its end
+        try:
             if len(close_prices) < 2:
                 logger.warning(f"Insufficient valid price data for {symbol}")
                 return None
 
-            return {
-                'date': end_date,
-                'cagr_1y': self._calculate_cagr(close_prices[-min(252, len(close_prices)):]),
-                'cagr_3y': self._calculate_cagr(close_prices[-min(756, len(close_prices)):]),
-                'cagr_5y': self._calculate_cagr(close_prices),
-                'volatility_1y': self._calculate_volatility(close_prices[-min(252, len(close_prices)):]),
-                'ma_50': np.mean(close_prices[-min(50, len(close_prices)):]),
-                'ma_200': np.mean(close_prices[-min(200, len(close_prices)):]),
-                'rsi_14': self._calculate_rsi(close_prices, 14),
-                'beta_1y': self._calculate_beta(symbol, dates[-min(252, len(dates)):], close_prices[-min(252, len(close_prices)):]),
-                'sharpe_ratio_1y': self._calculate_sharpe_ratio(close_prices[-min(252, len(close_prices)):]),
-                'max_drawdown_1y': self._calculate_max_drawdown(close_prices[-min(252, len(close_prices)):])
+            if anchors is None:
+                m_3y = min(3 * TRADING_DAYS, len(close_prices))
+                anchors = (len(close_prices), close_prices[-m_3y].item(), close_prices[0].item())
+            count, price_3y, price_5y = anchors
+
+            rsi_start, rsi_up, rsi_down = -1, 0.0, 0.0
+            if rsi_state is not None:
+                state_date, state_up, state_down = rsi_state
+                state_idx = np.searchsorted(dates, np.datetime64(state_date, 'D'))
+                if state_idx < len(dates) and dates[state_idx] == np.datetime64(state_date, 'D'):
+                    rsi_start, rsi_up, rsi_down = int(state_idx), state_up, state_down
+
+            (cagr_1y, volatility_1y, ma_50, ma_200, rsi_14, sharpe_ratio_1y, max_drawdown_1y,
+             rsi_up, rsi_down) = _metrics_kernel(close_prices, 14, RISK_FREE_RATE, rsi_start, rsi_up, rsi_down)
+            last = close_prices[-1].item()
+            metrics = {
+                'cagr_1y': cagr_1y if len(close_prices) >= MIN_CAGR_PRICES else None,
+                'cagr_3y': self._calculate_cagr(price_3y if price_3y is not None else price_5y, last, min(3 * TRADING_DAYS, count)),
+                'cagr_5y': self._calculate_cagr(price_5y, last, count),
+                'volatility_1y': volatility_1y,
+                'ma_50': ma_50,
+                'ma_200': ma_200,
+                'rsi_14': rsi_14,
+                'beta_1y': self._calculate_beta(dates[-TRADING_DAYS:], close_prices[-TRADING_DAYS:], market_prices),
+                'sharpe_ratio_1y': sharpe_ratio_1y,
+                'max_drawdown_1y': max_drawdown_1y
             }
+            # Undefined metrics (NaN from the kernel) are stored as NULL
+            metrics = {name: None if value is None or math.isnan(value) else value for name, value in metrics.items()}
+            # So are values the DECIMAL columns cannot hold, which would otherwise fail the whole batch upsert
+            for name, value in metrics.items():
+                if value is not None and round(abs(value), METRIC_SCALES[name]) >= 10 ** (10 - METRIC_SCALES[name]):
+                    logger.warning(f"Dropping out-of-range {name} for {symbol}: {value}")
+                    metrics[name] = None
+            metrics['date'] = end_date
+            metrics['rsi_state'] = None if math.isnan(rsi_up) else (dates[-2].item(), rsi_up, rsi_down)
+            return metrics
         except Exception as e:
             logger.error(f"Error calculating metrics for {symbol}: {e}")
             return None
 
-    
-    def _calculate_beta(self, symbol, dates, prices):
-        # Improved beta calculation (placeholder - needs market data)
-        market_prices = self._get_market_prices(dates)  # Implement this method
-        if market_prices is None:
+    def _calculate_cagr(self, first_price, last_price, count):
+        if count < MIN_CAGR_PRICES:
             return None
-        
-        stock_returns = np.diff(prices) / prices[:-1]
-        market_returns = np.diff(market_prices) / market_prices[:-1]
-        
-        covariance = np.cov(stock_returns, market_returns)[0][1]
-        market_variance = np.var(market_returns)
-        
-        return covariance / market_variance if market_variance != 0 else None
-
-    def _calculate_max_drawdown(self, prices):
-        peak = prices[0]
-        max_drawdown = 0
-        for price in prices[1:]:
-            if price > peak:
-                peak = price
-            drawdown = (peak - price) / peak
-            if drawdown > max_drawdown:
-                max_drawdown = drawdown
-        return max_drawdown
+        return (last_price / first_price) ** (TRADING_DAYS / count) - 1.0
+
+    def _to_arrays(self, prices):
+        # Single pass per column; dates become datetime64 so they can be aligned with NumPy
+        count = len(prices)
+        dates = np.fromiter((price_date for price_date, _ in prices), dtype='datetime64[D]', count=count)
+        close_prices = np.fromiter(
+            (price if price is not None else np.nan for _, price in prices), dtype=np.float64, count=count
+        )
+        valid = close_prices > 0
+        return dates[valid], close_prices[valid]
+
+    def _copy_recent_prices(self, cursor, symbols, start_date, end_date, tail_size=TRADING_DAYS):
+        # Only the last tail_size prices per symbol are needed once RSI state is carried between runs;
+        # the 3y/5y CAGR anchors and window size come back from the aggregate query.
+        # Fixed-width binary rows are streamed straight into NumPy instead of building a Python tuple per row;
+        # the caller must run this in a REPEATABLE READ transaction so counts and rows match
+        cursor.execute('''
+            SELECT symbol, COUNT(*),
+                   (array_agg(closing_price ORDER BY date DESC))[%s],
+                   (array_agg(closing_price ORDER BY date))[1]
+            FROM stock_prices
+            WHERE symbol = ANY(%s) AND date BETWEEN %s AND %s AND closing_price > 0
+            GROUP BY symbol
+            ORDER BY symbol
+        ''', (3 * TRADING_DAYS, symbols, start_date, end_date))
+        anchors = cursor.fetchall()
+
+        query = cursor.mogrify('''
+            COPY (
+                SELECT date, closing_price::float8
+                FROM (
+                    SELECT symbol, date, closing_price,
+                           row_number() OVER (PARTITION BY symbol ORDER BY date DESC) AS rn
+                    FROM stock_prices
+                    WHERE symbol = ANY(%s) AND date BETWEEN %s AND %s AND closing_price > 0
+                ) recent
+                WHERE rn <= %s
+                ORDER BY symbol, date
+            ) TO STDOUT WITH (FORMAT binary)
+        ''', (symbols, start_date, end_date, tail_size)).decode()
+        buf = io.BytesIO()
+        cursor.copy_expert(query, buf)
+
+        data = buf.getvalue()
+        header_end = PGCOPY_HEADER_SIZE + int.from_bytes(data[15:19], 'big')
+        row_count = (len(data) - header_end - 2) // PGCOPY_PRICE_ROW.itemsize  # 2-byte trailer
+        rows = np.frombuffer(data, dtype=PGCOPY_PRICE_ROW, offset=header_end, count=row_count)
+        dates = PG_EPOCH + rows['date'].astype('timedelta64[D]')
+        close_prices = rows['price'].astype(np.float64)
+
+        offsets = np.cumsum([min(count, tail_size) for _, count, _, _ in anchors], dtype=np.int64)[:-1]
+        for (symbol, count, price_3y, price_5y), symbol_dates, symbol_prices in zip(anchors, np.split(dates, offsets), np.split(close_prices, offsets)):
+            yield symbol, symbol_dates, symbol_prices, (count, price_3y, price_5y)
+
+    def _get_market_prices(self, start_date, end_date):
+        # The market index series is shared by every symbol, so callers should load it once
+        return self._to_arrays(self.get_stock_prices(MARKET_SYMBOL, start_date, end_date))
+
+    def _calculate_beta(self, dates, prices, market_prices):
+        market_dates, market_values = market_prices
+        _, stock_idx, market_idx = np.intersect1d(dates, market_dates, assume_unique=True, return_indices=True)
+        if len(stock_idx) < 3:
+            return None
+
+        stock_prices = prices[stock_idx]
+        index_prices = market_values[market_idx]
+        stock_returns = np.diff(stock_prices) / stock_prices[:-1]
+        market_returns = np.diff(index_prices) / index_prices[:-1]
+
+        covariance = np.cov(stock_returns, market_returns)
+        # Plain floats: indexing the matrix twice would box a NumPy scalar per access
+        stock_market_covariance, market_variance = covariance[0, 1].item(), covariance[1, 1].item()
+
+        return stock_market_covariance / market_variance if market_variance != 0 else None
+
+    def _metrics_row(self, symbol, metrics):
+        return (symbol, metrics['date']) + tuple(metrics[column] for column in METRIC_COLUMNS)
 
     def insert_metrics(self, symbol, metrics):
-        with self.get_cursor() as cursor:
-            cursor.execute('''
-                INSERT INTO stock_metrics 
-                (symbol, date, cagr_1y, cagr_3y, cagr_5y, volatility_1y, ma_50, ma_200, rsi_14, beta_1y, sharpe_ratio_1y, max_drawdown_1y)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (symbol, date) DO UPDATE
-                SET 
-                    cagr_1y = EXCLUDED.cagr_1y,
-                    cagr_3y = EXCLUDED.cagr_3y,
-                    cagr_5y = EXCLUDED.cagr_5y,
-                    volatility_1y = EXCLUDED.volatility_1y,
-                    ma_50 = EXCLUDED.ma_50,
-                    ma_200 = EXCLUDED.ma_200,
-                    rsi_14 = EXCLUDED.rsi_14,
-                    beta_1y = EXCLUDED.beta_1y,
-                    sharpe_ratio_1y = EXCLUDED.sharpe_ratio_1y,
-                    max_drawdown_1y = EXCLUDED.max_drawdown_1y
-            ''', (
-                symbol,
-                metrics['date'],
-                metrics['cagr_1y'],
-                metrics['cagr_3y'],
-                metrics['cagr_5y'],
-                metrics['volatility_1y'],
-                metrics['ma_50'],
-                metrics['ma_200'],
-                metrics['rsi_14'],
-                metrics['beta_1y'],
-                metrics['sharpe_ratio_1y'],
-                metrics['max_drawdown_1y']
-            ))
+        with self.get_cursor(commit=True) as cursor:
+            execute_values(cursor, UPSERT_METRICS_SQL, [self._metrics_row(symbol, metrics)])
         logger.info(f"Metrics inserted/updated for {symbol} on {metrics['date']}")
 
-    def update_all_metrics(self):
-        symbols = self.get_all_symbols()
+    def _select_stale_symbols(self, cursor, start_date, end_date):
+        # Symbols with prices in the window but no metrics row for end_date yet
+        cursor.execute('''
+            SELECT DISTINCT p.symbol
+            FROM stock_prices p
+            LEFT JOIN stock_metrics m ON m.symbol = p.symbol AND m.date = %s
+            WHERE p.date BETWEEN %s AND %s AND m.symbol IS NULL
+        ''', (end_date, start_date, end_date))
+        return [row[0] for row in cursor.fetchall()]
+
+    def update_all_metrics(self, force=False):
         end_date = date.today()
-        for symbol in symbols:
-            metrics = self.calculate_metrics(symbol, end_date)
-            if metrics:
-                self.insert_metrics(symbol, metrics)
+        five_years_ago = end_date - timedelta(days=5*365)
+        with self.get_cursor(commit=True) as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            if force:
+                cursor.execute("SELECT DISTINCT symbol FROM stock_prices WHERE date BETWEEN %s AND %s", (five_years_ago, end_date))
+                symbols = [row[0] for row in cursor.fetchall()]
+            else:
+                symbols = self._select_stale_symbols(cursor, five_years_ago, end_date)
+            if not symbols:
+                logger.info(f"Metrics already up to date for {end_date}")
+                return
+            rsi_states = {}
+            if not force:
+                # A forced run recomputes RSI from the price window instead of trusting saved state
+                cursor.execute("SELECT symbol, date, rsi_up, rsi_down FROM stock_metric_state")
+                rsi_states = {symbol: (state_date, rsi_up, rsi_down) for symbol, state_date, rsi_up, rsi_down in cursor.fetchall()}
+            # The market series is always loaded for beta, even when its own metrics are current
+            price_window = list(self._copy_recent_prices(cursor, list(set(symbols) | {MARKET_SYMBOL}), five_years_ago, end_date))
+            market_prices = next(
+                ((dates, close_prices) for symbol, dates, close_prices, _ in price_window if symbol == MARKET_SYMBOL),
+                (np.array([], dtype='datetime64[D]'), np.array([], dtype=np.float64))
+            )
+            stale_symbols = set(symbols)
+            price_window = [item for item in price_window if item[0] in stale_symbols]
+            results = [
+                (symbol, self._metrics_from_arrays(symbol, end_date, dates, close_prices, market_prices, anchors, rsi_states.get(symbol)))
+                for symbol, dates, close_prices, anchors in price_window
+            ]
+            metrics_rows = [self._metrics_row(symbol, metrics) for symbol, metrics in results if metrics]
+            state_rows = [
+                (symbol,) + metrics['rsi_state']
+                for symbol, metrics in results if metrics and metrics['rsi_state']
+            ]
+            if metrics_rows:
+                execute_values(cursor, UPSERT_METRICS_SQL, metrics_rows, page_size=500)
+            if state_rows:
+                execute_values(cursor, '''
+                    INSERT INTO stock_metric_state (symbol, date, rsi_up, rsi_down)
+                    VALUES %s
+                    ON CONFLICT (symbol) DO UPDATE
+                    SET date = EXCLUDED.date, rsi_up = EXCLUDED.rsi_up, rsi_down = EXCLUDED.rsi_down
+                ''', state_rows, page_size=500)
+        logger.info(f"Metrics inserted/updated for {len(metrics_rows)} symbols on {end_date}")
 
     def get_all_symbols(self):
-        with self.get_cursor(commit=False) as cursor:
+        with self.get_read_cursor() as cursor:
             cursor.execute("SELECT DISTINCT symbol FROM stock_prices")
             return [row[0] for row in cursor.fetchall()]
-
-    def _calculate_cagr(self, prices):
-        if len(prices) < 2:
-            return None
-        years = len(prices) / 252  # Assuming 252 trading days in a year
-        return (prices[-1] / prices[0]) ** (1/years) - 1
\ No newline at end of file
@@ -0,0 +1,169 @@
+import struct
+import unittest
+from datetime import date
+
+import numpy as np
+
+from fin_chatbot.services.postgres_manager import PostgresManager, _metrics_kernel, PG_EPOCH, RISK_FREE_RATE, TRADING_DAYS
+
+
+def random_prices(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return (100 * np.exp(np.cumsum(rng.normal(0, 0.02, count)))).round(2)
+
+
+def reference_metrics(prices):
+    # Straightforward NumPy versions of what _metrics_kernel computes in one pass
+    window = prices[-TRADING_DAYS:]
+    log_returns = np.diff(np.log(window))
+    returns = np.diff(window) / window[:-1]
+    deltas = np.diff(prices)
+    up, down = max(deltas[0], 0.0), max(-deltas[0], 0.0)
+    for delta in deltas[1:]:
+        up += (max(delta, 0.0) - up) / 14
+        down += (max(-delta, 0.0) - down) / 14
+    peaks = np.maximum.accumulate(window)
+    return {
+        'cagr_1y': (window[-1] / window[0]) ** (TRADING_DAYS / len(window)) - 1,
+        'volatility': log_returns.std() * np.sqrt(TRADING_DAYS),
+        'ma_50': prices[-50:].mean(),
+        'ma_200': prices[-200:].mean(),
+        'rsi': np.nan if len(prices) <= 14 else 100.0 if down == 0 else 100 - 100 / (1 + up / down),
+        'sharpe': np.nan if returns.std() == 0 else np.sqrt(TRADING_DAYS) * (returns.mean() - RISK_FREE_RATE / TRADING_DAYS) / returns.std(),
+        'max_drawdown': ((peaks - window) / peaks).max(),
+    }
+
+
+class FakeCopyCursor:
+    def __init__(self, anchors, copy_data):
+        self.anchors = anchors
+        self.copy_data = copy_data
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchall(self):
+        return self.anchors
+
+    def mogrify(self, query, params=None):
+        return query.encode()
+
+    def copy_expert(self, query, buf):
+        buf.write(self.copy_data)
+
+
+def pgcopy_buffer(rows, extension=b''):
+    # COPY ... TO STDOUT (FORMAT binary) output for (date, float8) rows
+    data = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, len(extension)) + extension
+    for price_date, price in rows:
+        days = (np.datetime64(price_date, 'D') - PG_EPOCH).astype(int)
+        data += struct.pack('>hiiid', 2, 4, days, 8, price)
+    return data + struct.pack('>h', -1)
+
+
+class TestMetricsKernel(unittest.TestCase):
+    def assertMatchesReference(self, prices):
+        result = _metrics_kernel(prices, 14, RISK_FREE_RATE, -1, 0.0, 0.0)
+        expected = reference_metrics(prices)
+        for value, name in zip(result, ('cagr_1y', 'volatility', 'ma_50', 'ma_200', 'rsi', 'sharpe', 'max_drawdown')):
+            if np.isnan(expected[name]):
+                self.assertTrue(np.isnan(value), name)
+            else:
+                self.assertAlmostEqual(value, expected[name], places=8, msg=name)
+
+    def test_random_series(self):
+        for count in (15, 300, 1260):
+            self.assertMatchesReference(random_prices(count))
+
+    def test_two_prices(self):
+        prices = np.array([100.0, 101.0])
+        self.assertMatchesReference(prices)
+        cagr_1y, volatility, _, _, rsi, sharpe, _, _, _ = _metrics_kernel(prices, 14, RISK_FREE_RATE, -1, 0.0, 0.0)
+        self.assertEqual(volatility, 0.0)
+        self.assertTrue(np.isnan(rsi))
+        self.assertTrue(np.isnan(sharpe))
+
+    def test_no_losses(self):
+        prices = np.linspace(100.0, 130.0, 30)
+        self.assertMatchesReference(prices)
+        self.assertEqual(_metrics_kernel(prices, 14, RISK_FREE_RATE, -1, 0.0, 0.0)[4], 100.0)
+
+    def test_resumed_state(self):
+        prices = random_prices(300)
+        for state_idx in (20, 150, 298):
+            *_, up, down = _metrics_kernel(prices[:state_idx + 2], 14, RISK_FREE_RATE, -1, 0.0, 0.0)
+            resumed = _metrics_kernel(prices, 14, RISK_FREE_RATE, state_idx, up, down)
+            self.assertAlmostEqual(resumed[4], reference_metrics(prices)['rsi'], places=8)
+
+
+class TestMetricsFromArrays(unittest.TestCase):
+    def setUp(self):
+        self.manager = PostgresManager()
+
+    def test_short_history(self):
+        dates = np.arange(np.datetime64('2024-01-01'), np.datetime64('2024-01-06'))
+        prices = np.array([10.0, 20.0, 30.0, 40.0, 60.0])
+        metrics = self.manager._metrics_from_arrays('TEST', date(2024, 1, 5), dates, prices, (dates, prices))
+        for name in ('cagr_1y', 'cagr_3y', 'cagr_5y', 'rsi_14'):
+            self.assertIsNone(metrics[name], name)
+        self.assertIsNone(metrics['rsi_state'])
+        self.assertAlmostEqual(metrics['ma_50'], 32.0)
+
+    def test_matches_reference(self):
+        dates = np.arange(np.datetime64('2020-01-01'), np.datetime64('2020-01-01') + 1000)
+        prices = random_prices(1000)
+        metrics = self.manager._metrics_from_arrays('TEST', date(2022, 9, 26), dates, prices, (dates, random_prices(1000, seed=1)))
+        expected = reference_metrics(prices)
+        self.assertAlmostEqual(metrics['cagr_1y'], expected['cagr_1y'], places=8)
+        self.assertAlmostEqual(metrics['rsi_14'], expected['rsi'], places=8)
+        self.assertAlmostEqual(metrics['cagr_5y'], (prices[-1] / prices[0]) ** (TRADING_DAYS / 1000) - 1, places=8)
+        self.assertAlmostEqual(metrics['cagr_3y'], (prices[-1] / prices[-756]) ** (1 / 3) - 1, places=8)
+
+
+class TestCopyRecentPrices(unittest.TestCase):
+    def test_parses_binary_copy(self):
+        anchors = [('AAA', 5, None, 10.0), ('BBB', 2, None, 70000.0)]
+        rows = [('2024-01-03', 12.5), ('2024-01-04', 13.25), ('2024-01-05', 14.0),
+                ('2024-01-04', 70000.0), ('2024-01-05', 70100.5)]
+        cursor = FakeCopyCursor(anchors, pgcopy_buffer(rows, extension=b'\x00' * 4))
+
+        result = list(PostgresManager()._copy_recent_prices(cursor, ['AAA', 'BBB'], date(2024, 1, 1), date(2024, 1, 5), tail_size=3))
+
+        self.assertEqual([item[0] for item in result], ['AAA', 'BBB'])
+        (_, aaa_dates, aaa_prices, aaa_anchors), (_, bbb_dates, bbb_prices, bbb_anchors) = result
+        np.testing.assert_array_equal(aaa_dates, np.array(['2024-01-03', '2024-01-04', '2024-01-05'], dtype='datetime64[D]'))
+        np.testing.assert_array_equal(aaa_prices, [12.5, 13.25, 14.0])
+        np.testing.assert_array_equal(bbb_dates, np.array(['2024-01-04', '2024-01-05'], dtype='datetime64[D]'))
+        np.testing.assert_array_equal(bbb_prices, [70000.0, 70100.5])
+        self.assertEqual(aaa_anchors, (5, None, 10.0))
+        self.assertEqual(bbb_anchors, (2, None, 70000.0))
+        self.assertEqual(aaa_prices.dtype, np.float64)
+
+
+class TestMetricState(unittest.TestCase):
+    def setUp(self):
+        self.manager = PostgresManager()
+        self.dates = np.arange(np.datetime64('2024-01-01'), np.datetime64('2024-01-01') + 300)
+        self.market = (self.dates, random_prices(300, seed=1))
+
+    def metrics(self, prices, rsi_state=None):
+        return self.manager._metrics_from_arrays(
+            'TEST', date(2024, 10, 27), self.dates[:len(prices)], prices, self.market, rsi_state=rsi_state
+        )
+
+    def test_state_is_saved_before_the_last_price(self):
+        prices = random_prices(300)
+        metrics = self.metrics(prices)
+        self.assertEqual(metrics['rsi_state'][0], self.dates[-2].item())
+
+    def test_resumed_rsi_matches_full_recompute(self):
+        prices = random_prices(300)
+        state = self.metrics(prices[:-1])['rsi_state']
+        self.assertAlmostEqual(self.metrics(prices, state)['rsi_14'], self.metrics(prices)['rsi_14'], places=8)
+
+    def test_revised_last_price_is_picked_up(self):
+        prices = random_prices(300)
+        state = self.metrics(prices)['rsi_state']
+        revised = prices.copy()
+        revised[-1] *= 1.1
+        self.assertAlmostEqual(self.metrics(revised, state)['rsi_14'], self.metrics(revised)['rsi_14'], places=8)